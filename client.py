@@ -1,26 +1,149 @@
 import asyncio
 import aiohttp
 import json
-from datetime import datetime
+import sys
+import time
+from typing import Optional
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    # orjson is optional; stdlib json also accepts raw bytes
+    _json_loads = json.loads
+    _JSONDecodeError = json.JSONDecodeError
+
+# SSE field prefix, compared against raw bytes so lines are never decoded
+_DATA_PREFIX = b'data: '
+_DATA_LEN = len(_DATA_PREFIX)
+
+# Ask for an uncompressed event stream so every event is delivered as soon as it is sent
+_SSE_HEADERS = {
+    "Accept": "text/event-stream",
+    "Accept-Encoding": "identity",
+    "Cache-Control": "no-cache"
+}
+_NDJSON_HEADERS = {**_SSE_HEADERS, "Accept": "application/x-ndjson"}
+
+# Response buffer size; above aiohttp's 64 KiB default so bursts are not throttled
+_READ_BUFSIZE = 256 * 1024
+
+# Console output is flushed once per this many events, and at most this many
+# seconds after an event is written, instead of on every line
+_FLUSH_EVERY = 20
+_FLUSH_INTERVAL = 0.1
+
+# Process-wide session shared by get_client() so SSE streams reuse pooled connections
+_SHARED_SESSION: Optional[aiohttp.ClientSession] = None
+_SHARED_CLIENT: Optional["ClientSSE"] = None
+
+
+async def _iter_sse_data(response):
+    """
+    Yield the raw payload of every SSE 'data:' line in the response body.
+    The body is read in whatever chunks the transport delivers and split on
+    newlines in a bytearray, so nothing is decoded before the JSON parse.
+    """
+    buf = bytearray()
+    async for chunk in response.content.iter_any():
+        buf += chunk
+        start = 0
+        while True:
+            end = buf.find(b'\n', start)
+            if end == -1:
+                break
+            if buf[start:start + _DATA_LEN] == _DATA_PREFIX:
+                yield buf[start + _DATA_LEN:end].rstrip()
+            start = end + 1
+        del buf[:start]
+    # A final event without a trailing newline
+    if buf[:_DATA_LEN] == _DATA_PREFIX:
+        yield buf[_DATA_LEN:].rstrip()
+
+
+async def _iter_ndjson_data(response):
+    """
+    Yield every non-blank line of a newline-delimited JSON body as raw bytes
+    """
+    buf = bytearray()
+    async for chunk in response.content.iter_any():
+        buf += chunk
+        end = buf.rfind(b'\n')
+        if end == -1:
+            continue
+        for line in buf[:end].split(b'\n'):
+            if line.strip():
+                yield line
+        del buf[:end + 1]
+    if buf.strip():
+        yield buf
+
+
+# Body reader and request headers for each stream format the server offers
+_STREAM_FORMATS = {
+    "sse": (_iter_sse_data, _SSE_HEADERS),
+    "ndjson": (_iter_ndjson_data, _NDJSON_HEADERS)
+}
+
 
 class ClientSSE:
-    def __init__(self, base_url="http://localhost:8000"):
+    def __init__(self, base_url="http://localhost:8000", session: Optional[aiohttp.ClientSession] = None,
+                 stream_format: str = "sse"):
         self.base_url = base_url
-        self.session = None
+        self.session = session
+        # "sse" or "ndjson"; ndjson skips the SSE framing on the wire
+        self.stream_format = stream_format
+        # An injected session belongs to the caller and is never closed here
+        self._owns_session = session is None
+        # Last formatted second, reused while events arrive within the same second
+        self._last_ts_int = -1
+        self._last_ts_str = ""
+        self._unflushed_events = 0
+        # Pending timer that flushes the tail of a burst when no more events come
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
     
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        await self._get_session()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        await self.close()
     
     async def _get_session(self):
         if self.session is None:
-            self.session = aiohttp.ClientSession()
+            self.session = aiohttp.ClientSession(read_bufsize=_READ_BUFSIZE, auto_decompress=False)
+            self._owns_session = True
         return self.session
     
+    def _format_timestamp(self, ts: float) -> str:
+        """
+        Format an event timestamp, caching the string for the current second
+        """
+        ts_int = int(ts)
+        if ts_int != self._last_ts_int:
+            self._last_ts_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts_int))
+            self._last_ts_int = ts_int
+        return self._last_ts_str
+    
+    def _write_event(self, lines: list):
+        """
+        Write all output lines of one event with a single stdout write
+        """
+        sys.stdout.write("\n".join(lines) + "\n")
+        self._unflushed_events += 1
+        if self._unflushed_events >= _FLUSH_EVERY:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(_FLUSH_INTERVAL, self._flush)
+    
+    def _flush(self):
+        sys.stdout.flush()
+        self._unflushed_events = 0
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+    
     async def health_check(self, interval: float = 1.0, max_checks: int = 10):
         """
         Perform health check with SSE streaming
@@ -53,28 +176,33 @@ class ClientSSE:
             "max_checks": max_checks
         }
         
-        async with session.post(f'{self.base_url}/health', json=payload) as response:
+        read_payloads, headers = _STREAM_FORMATS[self.stream_format]
+        async with session.post(f'{self.base_url}/health', json=payload, headers=headers,
+                                params={"format": self.stream_format}) as response:
             if response.status == 200:
-                async for line in response.content:
-                    line = line.decode('utf-8').strip()
-                    if line.startswith('data: '):
-                        try:
-                            log_data = json.loads(line[6:])
-                            timestamp = datetime.fromtimestamp(log_data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
-                            print(f"[{timestamp}] {log_data['level']}")
-                            print(f"  Full Response: {json.dumps(log_data, indent=2)}")
-                            
-                            # Also show specific fields for convenience
-                            if 'data' in log_data:
-                                data = log_data['data']
-                                if 'check_number' in data and 'total_checks' in data:
-                                    print(f"  Check: {data['check_number']}/{data['total_checks']}")
-                                if 'status' in data:
-                                    print(f"  Status: {data['status']}")
-                                if 'interval' in data:
-                                    print(f"  Interval: {data['interval']}")
-                        except json.JSONDecodeError as e:
-                            print(f"Error parsing JSON: {e}")
+                async for raw in read_payloads(response):
+                    try:
+                        log_data = _json_loads(raw)
+                        timestamp = self._format_timestamp(log_data['timestamp'])
+                        # Collect the event's output and write it in one go
+                        out = [
+                            f"[{timestamp}] {log_data['level']}",
+                            f"  Full Response: {json.dumps(log_data, indent=2)}"
+                        ]
+                        
+                        # Also show specific fields for convenience
+                        if 'data' in log_data:
+                            data = log_data['data']
+                            if 'check_number' in data and 'total_checks' in data:
+                                out.append(f"  Check: {data['check_number']}/{data['total_checks']}")
+                            if 'status' in data:
+                                out.append(f"  Status: {data['status']}")
+                            if 'interval' in data:
+                                out.append(f"  Interval: {data['interval']}")
+                        self._write_event(out)
+                    except _JSONDecodeError as e:
+                        print(f"Error parsing JSON: {e}")
+                self._flush()
             else:
                 print(f"Error: {response.status}")
     
@@ -88,75 +216,128 @@ class ClientSSE:
             "prefix": prefix
         }
         
-        async with session.post(f'{self.base_url}/execute', json=payload) as response:
+        read_payloads, headers = _STREAM_FORMATS[self.stream_format]
+        async with session.post(f'{self.base_url}/execute', json=payload, headers=headers,
+                                params={"format": self.stream_format}) as response:
             if response.status == 200:
-                async for line in response.content:
-                    line = line.decode('utf-8').strip()
-                    if line.startswith('data: '):
-                        try:
-                            log_data = json.loads(line[6:])
-                            timestamp = datetime.fromtimestamp(log_data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
-                            
-                            # Print the full response data
-                            print(f"[{timestamp}] {log_data['level']}")
-                            print(f"  Full Response: {json.dumps(log_data, indent=2)}")
-                            
-                            # Also show specific fields for convenience
-                            if 'data' in log_data:
-                                data = log_data['data']
-                                if 'stdout' in data and data['stdout']:
-                                    print(f"  STDOUT: {data['stdout']}")
-                                if 'stderr' in data and data['stderr']:
-                                    print(f"  STDERR: {data['stderr']}")
-                                if 'exit_code' in data:
-                                    print(f"  Exit Code: {data['exit_code']}")
-                                if 'status' in data:
-                                    print(f"  Status: {data['status']}")
-                                if 'namespace' in data:
-                                    print(f"  Namespace: {data['namespace']}")
-                                if 'prefix' in data:
-                                    print(f"  Prefix: {data['prefix']}")
-                                if 'command' in data:
-                                    print(f"  Command: {data['command']}")
-                                    
-                        except json.JSONDecodeError as e:
-                            print(f"Error parsing JSON: {e}")
+                async for raw in read_payloads(response):
+                    try:
+                        log_data = _json_loads(raw)
+                        timestamp = self._format_timestamp(log_data['timestamp'])
+                        
+                        # Collect the event's output and write it in one go
+                        out = [
+                            f"[{timestamp}] {log_data['level']}",
+                            f"  Full Response: {json.dumps(log_data, indent=2)}"
+                        ]
+                        
+                        # Also show specific fields for convenience
+                        if 'data' in log_data:
+                            data = log_data['data']
+                            # Batched events carry several lines under *_lines
+                            for line in data.get('stdout_lines', [data.get('stdout')]):
+                                if line:
+                                    out.append(f"  STDOUT: {line}")
+                            for line in data.get('stderr_lines', [data.get('stderr')]):
+                                if line:
+                                    out.append(f"  STDERR: {line}")
+                            if 'exit_code' in data:
+                                out.append(f"  Exit Code: {data['exit_code']}")
+                            if 'status' in data:
+                                out.append(f"  Status: {data['status']}")
+                            if 'namespace' in data:
+                                out.append(f"  Namespace: {data['namespace']}")
+                            if 'prefix' in data:
+                                out.append(f"  Prefix: {data['prefix']}")
+                            if 'command' in data:
+                                out.append(f"  Command: {data['command']}")
+                        self._write_event(out)
+                    except _JSONDecodeError as e:
+                        print(f"Error parsing JSON: {e}")
+                self._flush()
             else:
                 print(f"Error: {response.status}")
     
     async def close(self):
         """
-        Close the session
+        Close the session if this client created it
         """
-        if self.session:
+        if self.session and self._owns_session:
             await self.session.close()
             self.session = None
 
+
+def get_client(base_url="http://localhost:8000", stream_format: str = "sse") -> ClientSSE:
+    """
+    Return the process-wide ClientSSE backed by a shared, pooled session.
+    The session stays open across calls; close it once with close_shared_session().
+    """
+    global _SHARED_SESSION, _SHARED_CLIENT
+    if _SHARED_SESSION is None or _SHARED_SESSION.closed:
+        _SHARED_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=75),
+            read_bufsize=_READ_BUFSIZE,
+            auto_decompress=False
+        )
+        _SHARED_CLIENT = None
+    if (_SHARED_CLIENT is None or _SHARED_CLIENT.base_url != base_url
+            or _SHARED_CLIENT.stream_format != stream_format):
+        _SHARED_CLIENT = ClientSSE(base_url, session=_SHARED_SESSION, stream_format=stream_format)
+    return _SHARED_CLIENT
+
+
+async def close_shared_session():
+    """
+    Close the shared session; call once on shutdown from the running event loop
+    """
+    global _SHARED_SESSION, _SHARED_CLIENT
+    if _SHARED_SESSION is not None and not _SHARED_SESSION.closed:
+        await _SHARED_SESSION.close()
+    _SHARED_SESSION = None
+    _SHARED_CLIENT = None
+
+def install_uvloop():
+    """
+    Use uvloop as the asyncio event loop when it is installed
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return
+    uvloop.install()
+
 # Legacy functions for backward compatibility
 async def health_check_example():
     """
     Example client that performs health checks
     """
-    async with ClientSSE() as client:
-        print("Performing health check...")
-        await client.health_check(interval=0.5, max_checks=5)
+    client = get_client()
+    print("Performing health check...")
+    await client.health_check(interval=0.5, max_checks=5)
 
 async def script_execution_example():
     """
     Example client that executes scripts on Kubernetes
     """
-    async with ClientSSE() as client:
-        print("Executing script on Kubernetes...")
-        command = "echo 'Hello from K8s pod' && date"
-        namespace = "dbext-resources"
-        prefix = "sh6itcgl"
-        await client.execute_script(command, namespace, prefix)
+    client = get_client()
+    print("Executing script on Kubernetes...")
+    command = "echo 'Hello from K8s pod' && date"
+    namespace = "dbext-resources"
+    prefix = "sh6itcgl"
+    await client.execute_script(command, namespace, prefix)
+
+async def main():
+    try:
+        # await health_check_example()
+        await script_execution_example()
+    finally:
+        await close_shared_session()
 
 if __name__ == "__main__":
     print("Task Manager API Client Example")
     print("Make sure the server is running on http://localhost:8000")
     print("=" * 50)
     
-    # Run the examples
-    # asyncio.run(health_check_example())
-    asyncio.run(script_execution_example())
+    # Run the examples on one event loop so they share the pooled session
+    install_uvloop()
+    asyncio.run(main())
@@ -1,32 +1,38 @@
 import asyncio
-from client import ClientSSE
+from client import get_client, close_shared_session, install_uvloop
 
 async def health_check():
-    client = ClientSSE()
+    client = get_client()
     await client.health_check(interval=0.5, max_checks=5)
-    await client.close()
 
 
 async def execute_script_k8s():
-    client = ClientSSE()
+    client = get_client()
     command = "for i in {1..10}; do printf \"Log entry %s\\n\" $i; sleep 0.1; done"
     # command = "sleep 1 && ls /tmp"
     namespace = "dbext-resources"
     prefix = "sh6itcgl"
     await client.execute_script(command, namespace, prefix)
-    await client.close()
 
 
 async def execute_script_k8s_invalid():
-    client = ClientSSE()
+    client = get_client()
     invalid_command = "ls /wrong/path"
     # command = "sleep 1 && ls /tmp"
     namespace = "dbext-resources"
     prefix = "sh6itcgl"
     await client.execute_script(invalid_command, namespace, prefix)
-    await client.close()
+
+
+async def main():
+    # The shared session is bound to one event loop, so run everything on it
+    try:
+        await health_check()
+        await execute_script_k8s()
+        await execute_script_k8s_invalid()
+    finally:
+        await close_shared_session()
 
 if __name__ == "__main__":
-    asyncio.run(health_check())
-    asyncio.run(execute_script_k8s())
-    asyncio.run(execute_script_k8s_invalid())
\ No newline at end of file
+    install_uvloop()
+    asyncio.run(main())
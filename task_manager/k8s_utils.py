@@ -1,9 +1,120 @@
+import asyncio
+import json
 import logging
 import time
-from kubernetes import client, stream, config
+from functools import cached_property
+import aiohttp
+from kubernetes import client, config
 from fastapi.exceptions import HTTPException
 import os
 import re
+import ssl
+from urllib.parse import quote
+
+
+logger = logging.getLogger(__name__)
+
+# Websocket subprotocol for pod exec; every binary frame starts with a channel byte
+_EXEC_PROTOCOL = "v4.channel.k8s.io"
+
+# How long a resolved worker pod name is reused before listing pods again
+_POD_CACHE_TTL = 30.0
+
+# Upper bound on concurrent HTTP connections the shared ApiClient keeps to the API server
+_API_POOL_MAXSIZE = 32
+
+# Connection limits for the aiohttp session that carries exec websockets
+_HTTP_POOL_LIMIT = 64
+_HTTP_POOL_LIMIT_PER_HOST = 32
+_HTTP_KEEPALIVE_TIMEOUT = 75
+
+# Longest partial line held back waiting for a line break before it is sent as is
+_MAX_PARTIAL_LINE = 64 * 1024
+
+# Exit status embedded in exec error messages, e.g. "command terminated with non-zero exit code: 2"
+_EXIT_CODE_RE = re.compile(r'exit code[:\s]*(\d+)', re.IGNORECASE)
+
+# Channel ids prefixed to each binary frame by the Kubernetes exec protocol
+_STDOUT_CHANNEL = 1
+_STDERR_CHANNEL = 2
+# Carries a JSON Status object with the command's exit code when it finishes
+_ERROR_CHANNEL = 3
+
+# Shape of every in-progress event yielded by run_task_on_pod_v2; copied per read.
+# Both *_lines fields are always present so consumers need no key checks
+_RUNNING_EVENT = {
+    "status": "running",
+    "exit_code": None,
+    "stdout": "",
+    "stderr": "",
+    "stdout_lines": (),
+    "stderr_lines": (),
+    "timestamp": 0.0
+}
+
+
+# Set once the kube config has been loaded for this process
+_kube_config_loaded = False
+
+
+def _load_kube_config():
+    global _kube_config_loaded
+    if not _kube_config_loaded:
+        config.load_kube_config()
+        _kube_config_loaded = True
+
+
+def _drain_lines(buffer: bytearray, data) -> list:
+    """
+    Append data to buffer, then remove every complete line from the front of
+    buffer and return the non-blank ones decoded. A carriage return also ends
+    a line, so progress bars that redraw with \r are streamed as they update.
+    The incomplete tail stays in the buffer until more data arrives, unless it
+    grows past _MAX_PARTIAL_LINE, in which case it is returned as a line.
+    """
+    start = len(buffer)
+    buffer += data
+    # The buffered tail holds no line break, so only the new bytes are searched
+    end = max(buffer.rfind(b'\n', start), buffer.rfind(b'\r', start))
+    if end == -1:
+        if len(buffer) < _MAX_PARTIAL_LINE:
+            return []
+        end = len(buffer)
+    # Cutting at a line break never splits a UTF-8 sequence, so the complete
+    # lines can be decoded in one call instead of one decode per line
+    text = buffer[:end].decode('utf-8', 'replace')
+    del buffer[:end + 1]
+    # Only trailing whitespace is dropped so indentation survives
+    return [line for line in map(str.rstrip, text.replace('\r', '\n').split('\n')) if line]
+
+
+def _exit_status(payload: bytes) -> tuple:
+    """
+    Extract the exit code and failure message from the Status object sent on
+    the exec error channel
+    """
+    status = json.loads(payload)
+    if status.get("status") == "Success":
+        return 0, ""
+    message = status.get("message", "")
+    for cause in (status.get("details") or {}).get("causes") or []:
+        if cause.get("reason") == "ExitCode":
+            return int(cause["message"]), message
+    return 1, message
+
+
+def _output_event(channel: str, lines: list, timestamp: float):
+    """
+    Build one running event for all lines read from a channel in one go.
+    The lines always go under "stdout_lines"/"stderr_lines"; a single line is
+    also set as the plain "stdout"/"stderr" field.
+    """
+    event = _RUNNING_EVENT.copy()
+    event["timestamp"] = timestamp
+    event[f"{channel}_lines"] = lines
+    if len(lines) == 1:
+        event[channel] = lines[0]
+    return event
 
 
 class K8sClient:
@@ -11,165 +122,249 @@ class K8sClient:
 
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super(K8sClient, cls).__new__(cls)
-            cls._instance._initialize()
+            # Only publish the instance once it initialized, so a failed
+            # attempt is retried instead of handing out a half-built client
+            instance = super(K8sClient, cls).__new__(cls)
+            instance._initialize()
+            cls._instance = instance
         return cls._instance
 
     def _initialize(self):
-        logging.info("Initializing Kubernetes client...")
+        logger.info("Initializing Kubernetes client...")
         try:
             # Load the Kubernetes configuration
-            config.load_kube_config()
-            logging.info("Kubernetes configuration loaded successfully")
-            
-            # Create API clients after loading config
-            self.apps_v1 = client.AppsV1Api()
-            self.core_v1 = client.CoreV1Api()
-            self.api_client = client.ApiClient()
-            self.networking_v1 = client.NetworkingV1Api()
+            _load_kube_config()
+            logger.info("Kubernetes configuration loaded successfully")
             self.namespace = "default"
-            logging.info("Kubernetes API clients initialized successfully")
+            self._http_session = None
+            # (namespace, prefix) -> (pod name, monotonic time it was resolved)
+            self._pod_cache: dict[tuple[str, str], tuple[str, float]] = {}
         except Exception as e:
-            logging.error(f"Failed to initialize Kubernetes client: {str(e)}")
+            logger.error("Failed to initialize Kubernetes client: %s", e)
             raise HTTPException(
                 status_code=500, detail="Failed to initialize Kubernetes client"
             )
 
+    # API clients are built on first use so unused ones cost nothing; all of
+    # them share one ApiClient and therefore one connection pool
+    @cached_property
+    def apps_v1(self):
+        return client.AppsV1Api(self.api_client)
+
+    @cached_property
+    def core_v1(self):
+        return client.CoreV1Api(self.api_client)
+
+    @cached_property
+    def api_client(self):
+        return client.ApiClient(configuration=self.rest_config)
+
+    @cached_property
+    def networking_v1(self):
+        return client.NetworkingV1Api(self.api_client)
+
+    @cached_property
+    def rest_config(self):
+        # API server address and credentials resolved from the kube config
+        cfg = client.Configuration.get_default_copy()
+        cfg.connection_pool_maxsize = _API_POOL_MAXSIZE
+        return cfg
+
+    @cached_property
+    def ssl_context(self):
+        cfg = self.rest_config
+        if not cfg.host.startswith("https"):
+            return False
+        ctx = ssl.create_default_context(cafile=cfg.ssl_ca_cert)
+        if cfg.cert_file:
+            ctx.load_cert_chain(cfg.cert_file, cfg.key_file)
+        if not cfg.verify_ssl:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        return ctx
+
+    def auth_headers(self) -> dict:
+        # Looked up per call so tokens refreshed by the kube config are used.
+        # The refresh hook may run exec-credential plugins, so call it in a thread
+        token = self.rest_config.get_api_key_with_prefix("authorization")
+        return {"Authorization": token} if token else {}
+
+    async def http_session(self) -> aiohttp.ClientSession:
+        """
+        Return the aiohttp session used for exec websockets, created on first use.
+        Its pooled, TLS-configured connector is shared by every exec.
+        """
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=_HTTP_POOL_LIMIT,
+                    limit_per_host=_HTTP_POOL_LIMIT_PER_HOST,
+                    keepalive_timeout=_HTTP_KEEPALIVE_TIMEOUT,
+                    ssl=self.ssl_context
+                )
+            )
+        return self._http_session
+
+    async def close(self):
+        """
+        Close the exec session; call once on shutdown
+        """
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+
+    async def resolve_pod(self, prefix: str, namespace: str):
+        """
+        Return the name of a running pod labelled prefix=<prefix>, or None.
+        Names are cached for _POD_CACHE_TTL seconds to skip the API round-trip.
+        """
+        key = (namespace, prefix)
+        cached = self._pod_cache.get(key)
+        if cached is not None and time.monotonic() - cached[1] < _POD_CACHE_TTL:
+            return cached[0]
+
+        pods = await asyncio.to_thread(
+            self.core_v1.list_namespaced_pod,
+            namespace,
+            label_selector=f"prefix={prefix}",
+            field_selector="status.phase=Running",
+            limit=1,
+            _request_timeout=5
+        )
+        if not pods.items:
+            self._pod_cache.pop(key, None)
+            return None
+        pod_name = pods.items[0].metadata.name
+        self._pod_cache[key] = (pod_name, time.monotonic())
+        return pod_name
+
+    def invalidate_pod(self, prefix: str, namespace: str):
+        self._pod_cache.pop((namespace, prefix), None)
+
+    async def exec_ws(self, pod_name: str, namespace: str, command: list):
+        """
+        Open the exec websocket for command in the given pod
+        """
+        url = (f"{self.rest_config.host}/api/v1/namespaces/{quote(namespace, safe='')}"
+               f"/pods/{quote(pod_name, safe='')}/exec")
+        params = [("command", arg) for arg in command]
+        params += [("stdout", "true"), ("stderr", "true")]
+        http_session = await self.http_session()
+        return await http_session.ws_connect(
+            url,
+            params=params,
+            headers=await asyncio.to_thread(self.auth_headers),
+            protocols=(_EXEC_PROTOCOL,)
+        )
+
 
 class K8sApplication:
-    def __init__(self, template_folder: str, data: dict, session: dict):
+    def __init__(self, template_folder: str, data: dict, session: dict, k8s_client: K8sClient = None):
         self.session = session
         self.data = data
-        self.k8s_client = K8sClient()
+        self.k8s_client = k8s_client or K8sClient()
         self.template_folder = template_folder
 
-    def run_task_on_pod_v2(self, prefix: str, namespace: str, script: str):
+    async def run_task_on_pod_v2(self, prefix: str, namespace: str, script: str):
         """
         Run a task script on a worker pod with real-time line-by-line streaming.
-        Yields each line of stdout and stderr as a dict.
+        Yields one running dict per exec read, carrying that read's complete
+        lines under stdout_lines/stderr_lines, then a final completed or error dict.
+        The exec output is read from an aiohttp websocket and the pod lookup
+        runs in a worker thread, so the event loop is never blocked.
         """
         try:
-            # Get the pod name (assuming the pod name starts with the worker_name)
-            pods = self.k8s_client.core_v1.list_namespaced_pod(
-                namespace, label_selector=f"prefix={prefix}"
-            )
-            if not pods.items:
-                yield {
-                    "status": "error",
-                    "exit_code": 1,
-                    "stdout": "",
-                    "stderr": f"No pods found for worker '{prefix}' in namespace '{namespace}'"
-                }
-                return
-
-            pod_name = pods.items[0].metadata.name
-
-            # Create a wrapper script that captures exit code more reliably
-            # Use a temporary file approach to ensure exit code is captured
-            modified_script = f"""
-#!/bin/sh
-# Execute the original script and capture its exit code
-{script}
-SCRIPT_EXIT_CODE=$?
-
-# Always output the exit code to stderr (this will be captured)
-echo "EXIT_CODE:$SCRIPT_EXIT_CODE" >&2
-
-# Exit with the same code
-exit $SCRIPT_EXIT_CODE
-"""
-
-            exec_response = stream.stream(
-                self.k8s_client.core_v1.connect_get_namespaced_pod_exec,
-                name=pod_name,
-                namespace=namespace,
-                command=["/bin/sh", "-c", modified_script],
-                stderr=True,
-                stdin=False,
-                stdout=True,
-                tty=False,
-                _preload_content=False
-            )
+            # Speak the exec websocket protocol directly; frames are awaited on
+            # the event loop instead of polled from a blocking client
+            k8s_client = self.k8s_client
+            for attempt in range(2):
+                pod_name = await k8s_client.resolve_pod(prefix, namespace)
+                if pod_name is None:
+                    yield {
+                        "status": "error",
+                        "exit_code": 1,
+                        "stdout": "",
+                        "stderr": f"No pods found for worker '{prefix}' in namespace '{namespace}'",
+                        "timestamp": time.time()
+                    }
+                    return
+                try:
+                    ws = await k8s_client.exec_ws(
+                        pod_name, namespace, ["/bin/sh", "-c", script]
+                    )
+                    break
+                except aiohttp.WSServerHandshakeError as e:
+                    # A cached pod may have gone away; look it up again once
+                    if e.status != 404 or attempt:
+                        raise
+                    k8s_client.invalidate_pod(prefix, namespace)
 
-            # Read from the stream and yield lines as they arrive
-            try:
-                exit_code = 0  # Default to success
-                stdout_lines = []
-                stderr_lines = []
-                exit_code_found = False
+            async with ws:
+                # Checked once per exec so the per-frame path skips formatting when off
+                debug = logger.isEnabledFor(logging.DEBUG)
+                # Raw bytes are accumulated so lines split across frames are rejoined
+                stdout_buffer = bytearray()
+                stderr_buffer = bytearray()
+                status_buffer = bytearray()
+                
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.ERROR:
+                        # Connection reset, protocol error or heartbeat timeout;
+                        # iteration stops after this, so report it as a failure
+                        raise ws.exception() or msg.data
+                    if msg.type != aiohttp.WSMsgType.BINARY or len(msg.data) < 2:
+                        continue
+                    channel = msg.data[0]
+                    if debug:
+                        logger.debug("exec %s/%s: %d bytes on channel %d",
+                                     namespace, pod_name, len(msg.data) - 1, channel)
+                    if channel == _STDOUT_CHANNEL:
+                        lines = _drain_lines(stdout_buffer, memoryview(msg.data)[1:])
+                        if lines:
+                            yield _output_event("stdout", lines, time.time())
+                    elif channel == _STDERR_CHANNEL:
+                        lines = _drain_lines(stderr_buffer, memoryview(msg.data)[1:])
+                        if lines:
+                            yield _output_event("stderr", lines, time.time())
+                    elif channel == _ERROR_CHANNEL:
+                        status_buffer += memoryview(msg.data)[1:]
                 
-                # Simple approach: just read all data at once
-                while exec_response.is_open():
-                    exec_response.update(timeout=1)
-                    
-                    # Try to read any available data
-                    try:
-                        if exec_response.peek_stdout():
-                            stdout_data = exec_response.read_stdout()
-                            if stdout_data:
-                                # Split by newlines and yield each line
-                                lines = stdout_data.split('\n')
-                                for line in lines:
-                                    if line.strip():
-                                        stdout_lines.append(line.strip())
-                                        yield {
-                                            "status": "running",
-                                            "exit_code": None,
-                                            "stdout": line.strip(),
-                                            "stderr": ""
-                                        }
-                    except Exception as e:
-                        pass
-                    
-                    try:
-                        if exec_response.peek_stderr():
-                            stderr_data = exec_response.read_stderr()
-                            if stderr_data:
-                                # Split by newlines and yield each line
-                                lines = stderr_data.split('\n')
-                                for line in lines:
-                                    if line.startswith('EXIT_CODE:'):
-                                        try:
-                                            exit_code = int(line.split(':', 1)[1])
-                                            exit_code_found = True
-                                        except (ValueError, IndexError):
-                                            exit_code = 0
-                                    elif line.strip():
-                                        stderr_lines.append(line.strip())
-                                        yield {
-                                            "status": "running",
-                                            "exit_code": None,
-                                            "stdout": "",
-                                            "stderr": line.strip()
-                                        }
-                    except Exception as e:
-                        pass
+                # Flush output that did not end with a newline
+                now = time.time()
+                lines = _drain_lines(stdout_buffer, b'\n')
+                if lines:
+                    yield _output_event("stdout", lines, now)
+                lines = _drain_lines(stderr_buffer, b'\n')
+                if lines:
+                    yield _output_event("stderr", lines, now)
                 
-                # After stream closes, send final status with exit code
+                # After stream closes, send final status with the exit code
+                # reported on the error channel; the v4 protocol always sends
+                # one, so a stream that closed without it did not finish
+                if status_buffer:
+                    exit_code, message = _exit_status(status_buffer)
+                else:
+                    exit_code, message = 1, "Exec stream closed without an exit status"
                 status = "completed" if exit_code == 0 else "error"
                 yield {
                     "status": status,
                     "exit_code": exit_code,
                     "stdout": "",
-                    "stderr": ""
+                    "stderr": message,
+                    "timestamp": now
                 }
-            finally:
-                exec_response.close()
 
         except Exception as e:
             # Try to get exit code from the error message or use default
             exit_code = 1  # Default error exit code
-            if "exit code" in str(e).lower():
-                try:
-                    match = re.search(r'exit code[:\s]*(\d+)', str(e), re.IGNORECASE)
-                    if match:
-                        exit_code = int(match.group(1))
-                except (ValueError, IndexError):
-                    pass
+            match = _EXIT_CODE_RE.search(str(e))
+            if match:
+                exit_code = int(match.group(1))
             
             yield {
                 "status": "error",
                 "exit_code": exit_code,
                 "stdout": "",
-                "stderr": str(e)
+                "stderr": str(e),
+                "timestamp": time.time()
             }
\ No newline at end of file
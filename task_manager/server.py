@@ -1,124 +1,331 @@
 import asyncio
 import time
-from typing import AsyncGenerator
-from fastapi import FastAPI, HTTPException
+from contextlib import aclosing
+from typing import AsyncGenerator, Awaitable, Callable, Literal, NamedTuple
+import logging
+from fastapi import Depends, FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+from fastapi.websockets import WebSocketState
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-import json
-from k8s_utils import K8sApplication
+from pydantic import BaseModel, Field
+import orjson
+from k8s_utils import K8sApplication, K8sClient
 
 # Task Manager API with auto-reload support
 app = FastAPI(title="Task Manager API", description="API for managing and executing tasks on Kubernetes")
 
+class Framing(NamedTuple):
+    """
+    Bytes wrapped around each JSON-encoded event of a stream format
+    """
+    head: bytes
+    tail: bytes
+    content_type: str
+
+    def encode(self, payload: dict) -> bytes:
+        return self.head + orjson.dumps(payload) + self.tail
+
+SSE_FRAMING = Framing(b"data: ", b"\n\n", "text/event-stream")
+NDJSON_FRAMING = Framing(b"", b"\n", "application/x-ndjson")
+# One bare JSON document per WebSocket message
+MESSAGE_FRAMING = Framing(b"", b"", "application/json")
+
+# Stream formats selectable with ?format=; ndjson drops the SSE framing for
+# machine-to-machine consumers
+STREAM_FORMATS = {
+    "sse": SSE_FRAMING,
+    "ndjson": NDJSON_FRAMING
+}
+
+# Pending output is flushed after this many seconds, bytes or lines, in
+# events of at most _COALESCE_LINES lines each
+_COALESCE_INTERVAL = 0.01
+_COALESCE_BYTES = 4096
+_COALESCE_LINES = 32
+
+# Bytes streamed by one request before it yields to the event loop, so a
+# fast pod cannot starve other connections
+_YIELD_BYTES = 64 * 1024
+
+# Constant JSON pieces of an output event, in field order; the timestamp and
+# line arrays are serialized between them
+_OUTPUT_TIMESTAMP = b'{"timestamp":'
+_OUTPUT_STDOUT = b',"level":"INFO","data":{"stdout_lines":'
+_OUTPUT_STDERR = b',"stderr_lines":'
+
+# Seconds between client disconnect checks while the exec produces no output
+_DISCONNECT_POLL_INTERVAL = 1.0
+
+# Results buffered between the exec reader and a slow client before the
+# reader stops pulling frames off the exec websocket
+_QUEUE_MAXSIZE = 256
+
+# Queue sentinel marking the end of the k8s result stream
+_DONE = object()
+
+# Headers for every streaming response; the last two keep reverse proxies
+# (nginx) and compression middleware from holding events back until their
+# buffers fill
+_STREAM_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+    "Content-Encoding": "identity"
+}
+
+# Serializes the lazy creation of app.state.k8s_app so concurrent first
+# requests build a single client
+_k8s_app_lock = asyncio.Lock()
+
+def _create_k8s_app() -> K8sApplication:
+    # run_task_on_pod_v2 keeps no per-request state, so one mock session and
+    # data dict serve every request
+    return K8sApplication("", {}, {"user_id": "task_manager"}, K8sClient())
+
+@app.on_event("startup")
+async def init_k8s_app():
+    # Build the shared Kubernetes application once instead of on the request
+    # path; the server still starts (for /health) when no cluster is reachable
+    try:
+        k8s_app = _create_k8s_app()
+        # Open the pooled exec session now so the first request does not pay
+        # for it; building its TLS context fails on bad kube TLS material
+        await k8s_app.k8s_client.http_session()
+    except Exception as e:
+        logging.warning("Kubernetes client unavailable at startup; retrying on first /execute: %s", e)
+        app.state.k8s_app = None
+        return
+    app.state.k8s_app = k8s_app
+
+@app.on_event("shutdown")
+async def close_k8s_app():
+    k8s_app = getattr(app.state, "k8s_app", None)
+    if k8s_app is not None:
+        await k8s_app.k8s_client.close()
+
+async def get_k8s_app(connection: HTTPConnection) -> K8sApplication:
+    """
+    Dependency returning the process-wide Kubernetes application.
+    Async so FastAPI does not route every request through its threadpool.
+    """
+    # getattr: startup hooks do not run for e.g. a TestClient used without "with"
+    k8s_app = getattr(connection.app.state, "k8s_app", None)
+    if k8s_app is None:
+        async with _k8s_app_lock:
+            k8s_app = getattr(connection.app.state, "k8s_app", None)
+            if k8s_app is None:
+                # Loading the kube config blocks, so the rare retry runs in a thread
+                k8s_app = await asyncio.to_thread(_create_k8s_app)
+                connection.app.state.k8s_app = k8s_app
+    return k8s_app
+
 class LogRequest(BaseModel):
     count: int = 10
     delay: float = 1.0
 
 class K8sLogRequest(BaseModel):
-    command: str
-    namespace: str
-    prefix: str
+    command: str = Field(min_length=1)
+    namespace: str = Field(min_length=1)
+    prefix: str = Field(min_length=1)
 
 class HealthCheckRequest(BaseModel):
-    interval: float = 1.0
-    max_checks: int = 10
+    interval: float = Field(1.0, ge=0.1, le=10)
+    max_checks: int = Field(10, ge=1, le=100)
 
-async def health_check_sse_generate_loop(interval: float = 1.0, max_checks: int = 10) -> AsyncGenerator[str, None]:
+async def health_check_sse_generate_loop(interval: float = 1.0, max_checks: int = 10, framing: Framing = SSE_FRAMING) -> AsyncGenerator[bytes, None]:
     """
     Async generator that yields health check status with specified interval
     """
+    # Only the timestamp and check number vary and both are plain numbers, so
+    # each event is formatted into a preserialized template instead of dumped;
+    # repr() of a float is also its JSON form
+    template = b"".join((
+        framing.head,
+        b'{"timestamp":%a,"level":"INFO","data":{"check_number":%d,',
+        orjson.dumps({
+            "total_checks": max_checks,
+            "status": "healthy",
+            "interval": interval
+        })[1:],
+        b"}",
+        framing.tail
+    ))
+    # Sleep until fixed deadlines so time spent sending does not add up as drift
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
     for i in range(max_checks):
-        await asyncio.sleep(interval)
-        health_status = {
-            "timestamp": time.time(),
-            "level": "INFO",
-            "data": {
-                "check_number": i + 1,
-                "total_checks": max_checks,
-                "status": "healthy",
-                "interval": interval
-            }
-        }
-        yield f"data: {json.dumps(health_status)}\n\n"
+        deadline += interval
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+        yield template % (time.time(), i + 1)
 
-async def run_script_v2(command: str, namespace: str, prefix: str) -> AsyncGenerator[str, None]:
+async def _pump(source, queue: asyncio.Queue):
     """
-    Execute script on Kubernetes pod and stream results with line-by-line buffering
+    Forward every item of an async generator into queue, followed by _DONE.
+    An exception raised by the source is forwarded as an error result, so the
+    consumer only ever sees result dicts. The source is closed however the
+    pump ends, so cancelling it shuts the exec stream.
     """
     try:
-        # Create a mock session and data for K8sApplication
-        session = {"user_id": "task_manager"}
-        data = {"tenant_namespace": namespace}
+        async with aclosing(source):
+            async for item in source:
+                await queue.put(item)
+    except Exception as e:
+        await queue.put({
+            "status": "error",
+            "exit_code": 1,
+            "stdout": "",
+            "stderr": str(e),
+            "timestamp": time.time()
+        })
+    await queue.put(_DONE)
+
+async def run_script_v2(command: str, namespace: str, prefix: str, k8s_app: K8sApplication,
+                        framing: Framing = SSE_FRAMING,
+                        is_disconnected: Callable[[], Awaitable[bool]] = None) -> AsyncGenerator[bytes, None]:
+    """
+    Execute script on Kubernetes pod and stream results with line-by-line buffering.
+    Output lines are coalesced into one event per _COALESCE_INTERVAL seconds,
+    _COALESCE_BYTES bytes or _COALESCE_LINES lines, whichever comes first.
+    A batch holds lines from one stream only, so stdout and stderr keep their
+    relative order.
+    When is_disconnected is given it is polled while the exec is quiet, and the
+    exec is stopped as soon as it reports the client gone.
+    """
+    # Fields shared by every event of this request
+    request_fields = {"namespace": namespace, "prefix": prefix, "command": command}
+    pump = None
+    try:
+        # Execute command on pod; a separate task feeds results through a queue
+        # so pending output can be flushed on a timer while the pod is quiet.
+        # The queue is bounded so a slow client back-pressures the exec reader
+        queue = asyncio.Queue(maxsize=_QUEUE_MAXSIZE)
+        pump = asyncio.create_task(_pump(k8s_app.run_task_on_pod_v2(prefix, namespace, command), queue))
+        loop = asyncio.get_running_loop()
+        
+        # Output events differ only in timestamp and lines; everything else is
+        # serialized once per request and spliced around those fields
+        output_head = framing.head + _OUTPUT_TIMESTAMP
+        output_tail = b"," + orjson.dumps({"exit_code": None, **request_fields})[1:] + b"}" + framing.tail
         
-        # Initialize K8sApplication
-        k8s_app = K8sApplication("", data, session)
+        stdout_lines = []
+        stderr_lines = []
+        pending_bytes = 0
+        unyielded_bytes = 0
+        batch_timestamp = None
+        deadline = None
+        # Result held back while the pending batch of the other stream is sent
+        carry = None
         
-        # Execute command on pod and stream results
-        for result in k8s_app.run_task_on_pod_v2(prefix, namespace, command):
-            if result and isinstance(result, dict):
-                # Check if this is an error result
-                if result.get("status") == "error":
-                    log_entry = {
-                        "timestamp": time.time(),
-                        "level": "ERROR",
-                        "data": {
-                            "error": result.get("stderr", ""),
-                            "exit_code": result.get("exit_code", 1),
-                            "namespace": namespace,
-                            "prefix": prefix,
-                            "command": command
-                        }
+        while True:
+            if carry is not None:
+                result, carry = carry, None
+            else:
+                try:
+                    if deadline is not None:
+                        timeout = max(0.0, deadline - loop.time())
+                    elif is_disconnected is not None:
+                        timeout = _DISCONNECT_POLL_INTERVAL
+                    else:
+                        timeout = None
+                    result = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    # A quiet exec sends nothing, so a dropped client would go
+                    # unnoticed until the pod finishes; check for it here instead
+                    if deadline is None and await is_disconnected():
+                        break
+                    result = None
+            
+            if result is not None and result is not _DONE:
+                status = result["status"]
+                if status == "running":
+                    added_stdout = result["stdout_lines"]
+                    added_stderr = result["stderr_lines"]
+                    if (added_stdout and stderr_lines) or (added_stderr and stdout_lines):
+                        # Output switched streams; send the pending batch first
+                        # and start a new one with this result
+                        carry = result
+                        result = None
+                    else:
+                        # Collect output until the batch is due
+                        if batch_timestamp is None:
+                            batch_timestamp = result["timestamp"]
+                            deadline = loop.time() + _COALESCE_INTERVAL
+                        stdout_lines += added_stdout
+                        stderr_lines += added_stderr
+                        pending_bytes += sum(map(len, added_stdout)) + sum(map(len, added_stderr))
+                        if (pending_bytes < _COALESCE_BYTES
+                                and len(stdout_lines) + len(stderr_lines) < _COALESCE_LINES):
+                            continue
+            
+            final = result is not None and result is not _DONE and status != "running"
+            
+            # Flush the pending batch on timeout, size or line limit, or at the
+            # end of the stream, as events of at most _COALESCE_LINES lines; a
+            # final event carries the last of them itself
+            keep = _COALESCE_LINES if final else 0
+            sent_stdout = sent_stderr = 0
+            while len(stdout_lines) - sent_stdout + len(stderr_lines) - sent_stderr > keep:
+                chunk_stdout = stdout_lines[sent_stdout:sent_stdout + _COALESCE_LINES]
+                sent_stdout += len(chunk_stdout)
+                chunk_stderr = stderr_lines[sent_stderr:sent_stderr + _COALESCE_LINES - len(chunk_stdout)]
+                sent_stderr += len(chunk_stderr)
+                frame = b"".join((
+                    output_head, orjson.dumps(batch_timestamp),
+                    _OUTPUT_STDOUT, orjson.dumps(chunk_stdout),
+                    _OUTPUT_STDERR, orjson.dumps(chunk_stderr),
+                    output_tail
+                ))
+                yield frame
+                # A queue that is never empty lets this loop run without
+                # suspending; force a scheduling point every _YIELD_BYTES
+                unyielded_bytes += len(frame)
+                if unyielded_bytes >= _YIELD_BYTES:
+                    unyielded_bytes = 0
+                    await asyncio.sleep(0)
+            stdout_lines = stdout_lines[sent_stdout:]
+            stderr_lines = stderr_lines[sent_stderr:]
+            pending_bytes = 0
+            batch_timestamp = None
+            deadline = None
+            
+            if result is _DONE:
+                break
+            if not final:
+                continue
+            
+            # Check if this is an error result
+            if status == "error":
+                log_entry = {
+                    "timestamp": result["timestamp"],
+                    "level": "ERROR",
+                    "data": {
+                        "error": result.get("stderr", ""),
+                        "exit_code": result.get("exit_code", 1),
+                        "stdout_lines": stdout_lines,
+                        "stderr_lines": stderr_lines,
+                        **request_fields
                     }
-                    yield f"data: {json.dumps(log_entry)}\n\n"
-                else:
-                    # Handle stdout - send each line immediately as it comes
-                    if result.get("stdout"):
-                        log_entry = {
-                            "timestamp": time.time(),
-                            "level": "INFO",
-                            "data": {
-                                "stdout": result.get("stdout", ""),
-                                "stderr": "",
-                                "exit_code": result.get("exit_code", 0),
-                                "namespace": namespace,
-                                "prefix": prefix,
-                                "command": command
-                            }
-                        }
-                        yield f"data: {json.dumps(log_entry)}\n\n"
-                    
-                    # Handle stderr - send each line immediately as it comes
-                    if result.get("stderr"):
-                        log_entry = {
-                            "timestamp": time.time(),
-                            "level": "INFO",
-                            "data": {
-                                "stdout": "",
-                                "stderr": result.get("stderr", ""),
-                                "exit_code": result.get("exit_code", 0),
-                                "namespace": namespace,
-                                "prefix": prefix,
-                                "command": command
-                            }
-                        }
-                        yield f"data: {json.dumps(log_entry)}\n\n"
-                    
-                    # Handle completion status
-                    if result.get("status") == "completed":
-                        log_entry = {
-                            "timestamp": time.time(),
-                            "level": "INFO",
-                            "data": {
-                                "stdout": "",
-                                "stderr": "",
-                                "exit_code": result.get("exit_code", 0),
-                                "namespace": namespace,
-                                "prefix": prefix,
-                                "command": command,
-                                "status": "completed"
-                            }
-                        }
-                        yield f"data: {json.dumps(log_entry)}\n\n"
+                }
+                yield framing.encode(log_entry)
+            
+            # Handle completion status
+            elif status == "completed":
+                log_entry = {
+                    "timestamp": result["timestamp"],
+                    "level": "INFO",
+                    "data": {
+                        "stdout": "",
+                        "stderr": "",
+                        "stdout_lines": stdout_lines,
+                        "stderr_lines": stderr_lines,
+                        "exit_code": result.get("exit_code", 0),
+                        **request_fields,
+                        "status": "completed"
+                    }
+                }
+                yield framing.encode(log_entry)
+            stdout_lines = []
+            stderr_lines = []
                 
     except Exception as e:
         error_entry = {
@@ -126,62 +333,86 @@ async def run_script_v2(command: str, namespace: str, prefix: str) -> AsyncGener
             "level": "ERROR",
             "data": {
                 "error": str(e),
-                "namespace": namespace,
-                "prefix": prefix,
-                "command": command
+                **request_fields
             }
         }
-        yield f"data: {json.dumps(error_entry)}\n\n"
+        yield framing.encode(error_entry)
+    finally:
+        # Reached on completion and when the client disconnects; wait for the
+        # pump so the exec websocket is closed before the response ends
+        if pump is not None:
+            pump.cancel()
+            await asyncio.gather(pump, return_exceptions=True)
 
 @app.get("/")
 async def root():
     return {"message": "Task Manager API - Use /health for health checks or /execute for script execution"}
 
 @app.post("/health")
-async def health_check_sse(request: HealthCheckRequest):
+async def health_check_sse(request: HealthCheckRequest, format: Literal["sse", "ndjson"] = "sse"):
     """
     Health check endpoint with SSE streaming
     """
-    if request.interval < 0.1 or request.interval > 10:
-        raise HTTPException(status_code=400, detail="Interval must be between 0.1 and 10 seconds")
-    
-    if request.max_checks < 1 or request.max_checks > 100:
-        raise HTTPException(status_code=400, detail="Max checks must be between 1 and 100")
-    
+    framing = STREAM_FORMATS[format]
     return StreamingResponse(
-        health_check_sse_generate_loop(request.interval, request.max_checks),
-        media_type="text/plain",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream"
-        }
+        health_check_sse_generate_loop(request.interval, request.max_checks, framing),
+        media_type=framing.content_type,
+        headers=_STREAM_HEADERS
     )
 
 @app.post("/execute")
-async def execute_script(request: K8sLogRequest):
+async def execute_script(request: K8sLogRequest, http_request: Request, format: Literal["sse", "ndjson"] = "sse",
+                         k8s_app: K8sApplication = Depends(get_k8s_app)):
     """
     Execute script on Kubernetes pod with SSE streaming
     """
-    if not request.command:
-        raise HTTPException(status_code=400, detail="Command is required")
+    framing = STREAM_FORMATS[format]
+    return StreamingResponse(
+        run_script_v2(request.command, request.namespace, request.prefix, k8s_app, framing,
+                      http_request.is_disconnected),
+        media_type=framing.content_type,
+        headers=_STREAM_HEADERS
+    )
+
+@app.websocket("/ws/execute")
+async def execute_script_ws(websocket: WebSocket, k8s_app: K8sApplication = Depends(get_k8s_app)):
+    """
+    Execute script on Kubernetes pod over a WebSocket.
+    The first message must be a JSON object with command, namespace and prefix;
+    results are sent back as one binary JSON message per event. Any further
+    message from the client, or a disconnect, cancels the execution.
+    """
+    await websocket.accept()
+    try:
+        request = K8sLogRequest(**await websocket.receive_json())
+    except WebSocketDisconnect:
+        return
+    except (ValueError, TypeError, KeyError):
+        # KeyError: Starlette reads message["text"], which a binary frame lacks
+        await websocket.close(code=1003, reason="Command, namespace and prefix are required")
+        return
     
-    if not request.namespace:
-        raise HTTPException(status_code=400, detail="Namespace is required")
+    async def send_results():
+        results = run_script_v2(request.command, request.namespace, request.prefix, k8s_app, MESSAGE_FRAMING)
+        async with aclosing(results):
+            async for message in results:
+                await websocket.send_bytes(message)
     
-    if not request.prefix:
-        raise HTTPException(status_code=400, detail="Prefix is required")
+    sender = asyncio.create_task(send_results())
+    receiver = asyncio.create_task(websocket.receive())
+    await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    sender.cancel()
+    receiver.cancel()
+    # Let the exec stream shut down before the handler returns
+    await asyncio.gather(sender, receiver, return_exceptions=True)
     
-    return StreamingResponse(
-        run_script_v2(request.command, request.namespace, request.prefix),
-        media_type="text/plain",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream"
-        }
-    )
+    if websocket.client_state != WebSocketState.DISCONNECTED:
+        await websocket.close()
 
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" picks uvloop and httptools when they are installed; multiple
+    # workers need the app as an import string (run from this directory)
+    uvicorn.run("server:app", host="0.0.0.0", port=8000, loop="auto", http="auto",
+                workers=os.cpu_count(), log_level="warning")